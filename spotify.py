@@ -1,10 +1,20 @@
+import functools
+import hashlib
+import itertools
+import json
 import logging
 import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Callable, Dict, Iterable
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
 
+from requests.adapters import HTTPAdapter
 from spotipy import Spotify
 from spotipy.cache_handler import CacheFileHandler
+from spotipy.exceptions import SpotifyException
 from spotipy.oauth2 import SpotifyOAuth
 
 CLIENT_ID = os.getenv("SPOTIPY_CLIENT_ID", "aba916bbd6214fdc8bc993344439c58e")
@@ -18,23 +28,189 @@ SCOPES = (
     "user-follow-read",
     "user-read-recently-played",
 )
+# Number of pages of a paginated result fetched concurrently
+MAX_PAGE_WORKERS = 8
+# Number of keep-alive connections to the Spotify API kept open for reuse
+HTTP_POOL_SIZE = 20
+# Maximum number of requests in flight at any time, across all clients and
+# threads. Concurrent backups each paginate concurrently, so without a global
+# limit the number of parallel requests would multiply.
+MAX_CONCURRENT_REQUESTS = 10
+# Number of times a request is retried after being rate limited (HTTP 429)
+MAX_RATE_LIMIT_RETRIES = 5
 
 logger = logging.getLogger(__name__)
 
 
+class _RetriedRequestFilter(logging.Filter):
+    """Drop spotipy's error messages about failed requests that are going to be retried
+
+    SpotifyClient._internal_call sets the HTTP statuses it would retry the
+    current request on (per thread), so only final failures are logged.
+    """
+
+    STATUS_RE = re.compile(r"HTTP Error .* returned (\d+) due to")
+
+    def __init__(self):
+        super().__init__()
+        self._local = threading.local()
+
+    def set_retried_statuses(self, statuses: Iterable[int]):
+        self._local.statuses = frozenset(statuses)
+
+    def filter(self, record):
+        match = self.STATUS_RE.match(record.getMessage())
+        return not (match and int(match[1]) in getattr(self._local, "statuses", ()))
+
+
+_retried_request_filter = _RetriedRequestFilter()
+logging.getLogger("spotipy.client").addFilter(_retried_request_filter)
+
+
+def setup_logging(verbose: Optional[int]):
+    """Setup logging for the command line tools, verbose being the number of -v flags"""
+    level = logging.WARNING
+    if verbose is not None:
+        if verbose > 0:
+            level = logging.INFO
+        if verbose > 1:
+            level = logging.DEBUG
+    logging.basicConfig(
+        format="%(asctime)s [%(levelname)s] (%(name)s.%(funcName)s) %(message)s",
+        level=level,
+    )
+
+
+class MemoizingCacheFileHandler(CacheFileHandler):
+    """CacheFileHandler that keeps the token in memory once it has been read
+
+    Spotipy asks the cache handler for the token on every single API request,
+    which would otherwise mean reading and parsing the cache file each time.
+    The token is shared between all handlers of the same cache file.
+    """
+
+    _tokens: Dict[str, Dict] = {}
+
+    def get_cached_token(self):
+        token_info = self._tokens.get(self.cache_path)
+        if token_info is None:
+            token_info = super().get_cached_token()
+            if token_info is not None:
+                self._tokens[self.cache_path] = token_info
+        return token_info
+
+    def save_token_to_cache(self, token_info):
+        super().save_token_to_cache(token_info)
+        self._tokens[self.cache_path] = token_info
+
+
+@functools.cache
+def get_auth_manager() -> SpotifyOAuth:
+    """Return the SpotifyOAuth instance shared by all clients"""
+    return SpotifyOAuth(
+        client_id=CLIENT_ID,
+        redirect_uri=REDIRECT_URI,
+        open_browser=False,
+        scope=",".join(SCOPES),
+        cache_handler=MemoizingCacheFileHandler(
+            cache_path=str(SpotifyClient.cache_path())
+        ),
+    )
+
+
 class SpotifyClient(Spotify):
+    _request_slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+    # Rate limiting is per app and user, so once Spotify asks us to back off,
+    # all requests (of all clients and threads) are held back until then.
+    _rate_limit_lock = threading.Lock()
+    _rate_limited_until = 0.0
+
     def __init__(self):
-        self._auth_manager = SpotifyOAuth(
-            client_id=CLIENT_ID,
-            redirect_uri=REDIRECT_URI,
-            open_browser=False,
-            scope=",".join(SCOPES),
-            cache_handler=CacheFileHandler(cache_path=self.cache_path()),
-        )
-        status_forcelist = list(Spotify.default_retry_codes)
+        self._auth_manager = get_auth_manager()
+        # Rate limited requests (429) are retried by _internal_call
+        status_forcelist = [c for c in Spotify.default_retry_codes if c != 429]
         status_forcelist.append(401)
         super().__init__(auth_manager=self._auth_manager, status_forcelist=status_forcelist)
-        self.user_id = self.me()["id"]
+        # Authorize (or refresh the token) now, on the calling thread. Otherwise the
+        # first requests, made concurrently by worker threads, would each ask for
+        # authorization on the first run.
+        self._auth_manager.get_access_token(as_dict=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _build_session(self):
+        """Build the session with a connection pool large enough to keep a
+        connection alive for each of the concurrently running requests"""
+        super()._build_session()
+        # Keep the retry configuration of the adapter spotipy has set up for connection
+        # errors only. Retrying on status codes (with backoff or when Spotify sends a
+        # Retry-After header) is done by _internal_call, so that a slot of
+        # _request_slots is not held while waiting.
+        retry = self._session.get_adapter(self.prefix).max_retries
+        retry = retry.new(
+            status_forcelist=None,
+            respect_retry_after_header=False,
+            backoff_factor=0,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=HTTP_POOL_SIZE,
+            pool_maxsize=HTTP_POOL_SIZE,
+            max_retries=retry,
+        )
+        self._session.mount("https://", adapter)
+
+    def _internal_call(self, method, url, payload, params):
+        rate_limit_retries = 0
+        status_retries = 0
+        while True:
+            delay = SpotifyClient._rate_limited_until - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            retried_statuses = set()
+            if rate_limit_retries < MAX_RATE_LIMIT_RETRIES:
+                retried_statuses.add(429)
+            if status_retries < self.status_retries:
+                retried_statuses.update(self.status_forcelist)
+            _retried_request_filter.set_retried_statuses(retried_statuses)
+            try:
+                with self._request_slots:
+                    # spotipy modifies params, so pass a copy to be able to retry
+                    return super()._internal_call(method, url, payload, dict(params))
+            except SpotifyException as e:
+                if e.http_status == 429 and rate_limit_retries < MAX_RATE_LIMIT_RETRIES:
+                    rate_limit_retries += 1
+                    retry_after = int((e.headers or {}).get("Retry-After", 1))
+                    logger.warning("Rate limited, retrying in %d seconds", retry_after)
+                    with SpotifyClient._rate_limit_lock:
+                        SpotifyClient._rate_limited_until = max(
+                            SpotifyClient._rate_limited_until,
+                            time.monotonic() + retry_after,
+                        )
+                elif (
+                    e.http_status in self.status_forcelist
+                    and status_retries < self.status_retries
+                ):
+                    # Same backoff urllib3 would use for spotipy's retry configuration
+                    status_retries += 1
+                    backoff = self.backoff_factor * 2 ** (status_retries - 1)
+                    logger.warning(
+                        "Request failed (HTTP %d), retrying in %.1f seconds",
+                        e.http_status,
+                        backoff,
+                    )
+                    time.sleep(backoff)
+                else:
+                    raise
+            finally:
+                _retried_request_filter.set_retried_statuses(())
+
+    def close(self):
+        """Close all connections of the underlying session"""
+        self._session.close()
 
     @staticmethod
     def cache_path() -> Path:
@@ -44,20 +220,86 @@ class SpotifyClient(Spotify):
             "spotify-backup",
         )
 
-    def get_all_items(self, func: Callable, **kwargs) -> Dict:
+    @staticmethod
+    def profile_path() -> Path:
+        cache_path = SpotifyClient.cache_path()
+        return cache_path.with_name(cache_path.name + ".profile.json")
+
+    def _token_hash(self) -> str:
+        """Hash of the refresh token, which identifies the authorized user"""
+        token_info = self._auth_manager.cache_handler.get_cached_token() or {}
+        refresh_token = token_info.get("refresh_token", "")
+        return hashlib.sha256(refresh_token.encode()).hexdigest()
+
+    @functools.cached_property
+    def user_id(self) -> str:
+        """ID of the current user
+
+        The ID is cached on disk for the refresh token it has been fetched with,
+        so the extra request is only needed after authorizing (again).
+        """
+        profile_path = self.profile_path()
+        try:
+            with open(profile_path, "r") as f:
+                profile = json.load(f)
+            if profile["token_hash"] == self._token_hash():
+                return profile["user_id"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        user_id = self.me()["id"]
+        try:
+            with open(profile_path, "w") as f:
+                json.dump({"user_id": user_id, "token_hash": self._token_hash()}, f)
+        except OSError as e:
+            logger.warning("Unable to cache user profile: %s", e)
+        return user_id
+
+    def get_all_items(self, func: Callable, **kwargs) -> List:
         """Return all items for a paginated result set of Spotify"""
-        result = func(**kwargs)
-        items = result["items"]
+        return list(self.iter_all_items(func, **kwargs))
+
+    def iter_all_items(self, func: Callable, **kwargs) -> Iterator:
+        """Yield all items for a paginated result set of Spotify"""
+        yield from self.iter_remaining_items(func(**kwargs), func, **kwargs)
+
+    def get_remaining_items(self, result: Dict, func: Callable, **kwargs) -> List:
+        """Return the items of a result page plus the items of all following pages"""
+        return list(self.iter_remaining_items(result, func, **kwargs))
+
+    def iter_remaining_items(self, result: Dict, func: Callable, **kwargs) -> Iterator:
+        """Yield the items of a result page plus the items of all following pages
+
+        The first page tells the total number of items, so the offsets of all
+        remaining pages are known upfront and those pages are fetched
+        concurrently (calling func with limit, offset and kwargs). Items are
+        yielded in the order of the result set.
+        """
+        yield from result["items"]
+        if not result["next"]:
+            return
+
+        limit = result["limit"]
+        offsets = range(result["offset"] + limit, result["total"], limit)
+        with ThreadPoolExecutor(max_workers=MAX_PAGE_WORKERS) as executor:
+            # map() yields the pages in order, as soon as each one is available
+            # limit and offset (if given) are replaced by the ones of each page
+            for result in executor.map(
+                lambda offset: func(**{**kwargs, "limit": limit, "offset": offset}),
+                offsets,
+            ):
+                yield from result["items"]
+        # Pick up items that have been added since the first page was fetched
         while result["next"]:
             result = self.next(result)
-            items.extend(result["items"])
-        return items
+            yield from result["items"]
 
     @staticmethod
-    def chunks(lst: Iterable, n: int) -> Iterable[Any]:
-        """Yield successive n-sized chunks from lst."""
-        for i in range(0, len(lst), n):
-            yield lst[i : i + n]
+    def chunks(iterable: Iterable, n: int) -> Iterator[List]:
+        """Yield successive n-sized chunks from iterable."""
+        it = iter(iterable)
+        while chunk := list(itertools.islice(it, n)):
+            yield chunk
 
     def create_playlist(self, name: str, uris: Iterable[str]) -> Dict:
         """Create a copy of the playlist in json_path"""
@@ -74,6 +316,10 @@ class SpotifyClient(Spotify):
         logger.debug("Destination playlist ID: %s", dst_id)
 
         count = 0
+        # The chunks are added one after another on purpose: Spotify rejects a
+        # position beyond the current length of the playlist, so adding them
+        # concurrently (even with explicit positions) could fail or mix up the
+        # order of tracks.
         for chunk in self.chunks(uris, 100):
             count += len(chunk)
             self.playlist_add_items(dst_id, chunk)
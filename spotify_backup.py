@@ -1,19 +1,45 @@
 #!/usr/bin/env python3
 
 import argparse
+import filecmp
 import json
 import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple, get_args
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    get_args,
+)
 
 try:
     from typing import Literal
 except ImportError:
     from typing_extensions import Literal  # type: ignore
 
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type: ignore
+
 from spotipy.exceptions import SpotifyException
 
-from spotify import SpotifyClient
+from spotify import SpotifyClient, setup_logging
 from spotify_history import SpotifyHistoryDB
 
 _SAVED_OBJECT_TYPES = Literal["albums", "episodes", "shows", "tracks"]
@@ -22,25 +48,136 @@ _TOP_OBJECT_TYPES = Literal["artists", "tracks"]
 TOP_OBJECT_TYPES: Tuple[_TOP_OBJECT_TYPES, ...] = get_args(_TOP_OBJECT_TYPES)
 _TOP_RANGES = Literal["short_term", "medium_term", "long_term"]
 TOP_RANGES: Tuple[_TOP_RANGES, ...] = get_args(_TOP_RANGES)
+# Number of backups (playlists, saved/top objects) fetched concurrently. The
+# run is dominated by network round-trips, so overlapping them cuts wall time
+# while staying well below Spotify's rate limit.
+MAX_WORKERS = 8
+# Fields of playlists (and their items) to request for "slim" backups
+PLAYLIST_ITEM_FIELDS = (
+    "added_at,added_by.id,is_local,"
+    "track(id,name,uri,duration_ms,external_ids,artists(id,name),album(id,name))"
+)
+PLAYLIST_FIELDS = (
+    "id,name,description,public,collaborative,snapshot_id,owner.id,"
+    f"tracks.items({PLAYLIST_ITEM_FIELDS}),"
+    "tracks.next,tracks.total,tracks.limit,tracks.offset"
+)
+PLAYLIST_PAGE_FIELDS = f"items({PLAYLIST_ITEM_FIELDS}),next,total,limit,offset"
+# Playlist backups are written with sorted keys, so the snapshot_id is found
+# before the tracks, within the first few KiB of the file.
+SNAPSHOT_ID_RE = re.compile(rb'"snapshot_id":\s*"([^"\\]*)"')
+SNAPSHOT_ID_READ_SIZE = 16 * 1024
+# Index of the snapshot_id of every playlist backup (in the playlists directory),
+# so that checking if a backup is up to date doesn't require reading it.
+SNAPSHOT_IDS_FILE = "snapshots.json"
+# zstd compression level for --compress, the default level of the zstd CLI
+ZSTD_LEVEL = 3
+# Errors raised when reading a broken (e.g. truncated) backup file
+BACKUP_READ_ERRORS: Tuple[Type[Exception], ...] = (OSError, ValueError)
+if zstandard is not None:
+    BACKUP_READ_ERRORS += (zstandard.ZstdError,)
 
 logger = logging.getLogger(__name__)
 
 
 class SpotifyBackup:
-    def __init__(self, backup_path: Path, pretty: bool = False):
+    def __init__(
+        self,
+        backup_path: Path,
+        pretty: bool = False,
+        slim: bool = False,
+        compress: bool = False,
+        workers: int = MAX_WORKERS,
+    ):
         self.pretty = pretty
+        self.slim = slim
+        self.compress = compress
+        self.workers = workers
         self.backup_path = backup_path
         self.sp = SpotifyClient()
+        self._snapshot_ids = self._load_snapshot_ids()
+        # API methods to fetch the saved and top objects of each type
+        self._saved_fetchers: Dict[str, Callable] = {
+            t: getattr(self.sp, f"current_user_saved_{t}") for t in SAVED_OBJECT_TYPES
+        }
+        self._top_fetchers: Dict[str, Callable] = {
+            t: getattr(self.sp, f"current_user_top_{t}") for t in TOP_OBJECT_TYPES
+        }
+
+    def _dumps(self, j: Any) -> bytes:
+        if orjson is not None:
+            option = orjson.OPT_SORT_KEYS
+            if self.pretty:
+                option |= orjson.OPT_INDENT_2
+            return orjson.dumps(j, option=option)
+        kwargs = {"sort_keys": True}
+        if self.pretty:
+            kwargs["indent"] = 2
+        return json.dumps(j, **kwargs).encode()
+
+    def _iter_json_array(self, items: Iterable) -> Iterator[bytes]:
+        """Encode items as JSON array one item at a time
+
+        The result is identical to encoding the list of items as a whole.
+        """
+        if self.pretty:
+            start, sep, end = b"[\n  ", b",\n  ", b"\n]"
+        else:
+            start, sep, end = b"[", b"," if orjson is not None else b", ", b"]"
+        empty = True
+        for item in items:
+            data = self._dumps(item)
+            if self.pretty:
+                # Indent the item by one level, JSON strings can't contain newlines
+                data = data.replace(b"\n", b"\n  ")
+            yield (start if empty else sep) + data
+            empty = False
+        yield b"[]" if empty else end
 
     def _dump_json(self, path: Path, j: Dict):
+        self._write(path, (self._dumps(j),))
+
+    def _dump_json_array(self, path: Path, items: Iterable):
+        """Like _dump_json, but streams the items to disk one by one"""
+        self._write(path, self._iter_json_array(items))
+
+    def _backup_file(self, path: Path) -> Path:
+        """Return path with the suffix of the backup files (.json or .json.zst)"""
+        if self.compress and path.suffix == ".zst":
+            return path
         # Ensure .json suffix
         if not path.suffix == ".json":
             path = path.parent / (path.name + ".json")
-        kwargs = {"sort_keys": True}
-        if self.pretty:
-            kwargs["indent"] = 2
-        with open(path, "w") as f:
-            json.dump(j, f, **kwargs)
+        if self.compress:
+            path = path.parent / (path.name + ".zst")
+        return path
+
+    def _write(self, path: Path, chunks: Iterable[bytes]):
+        path = self._backup_file(path)
+        # Write to a temporary file first and move it in place afterwards so
+        # that an interrupted run never leaves a truncated backup behind.
+        tmp_path = path.with_name(path.name + ".tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                if self.compress:
+                    cctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+                    compressor = cctx.compressobj()
+                    for chunk in chunks:
+                        f.write(compressor.compress(chunk))
+                    f.write(compressor.flush())
+                else:
+                    for chunk in chunks:
+                        f.write(chunk)
+        except BaseException:
+            # Fetching the data (chunks might be generated lazily) failed
+            tmp_path.unlink(missing_ok=True)
+            raise
+        if path.exists() and filecmp.cmp(tmp_path, path, shallow=False):
+            # Don't touch files for no reason, see _backup_playlist
+            logger.debug("%s: Backup is up to date", path)
+            tmp_path.unlink()
+            return
+        os.replace(tmp_path, path)
 
     def _ensure_dir(self, what: Optional[Path] = None) -> Path:
         if what is None:
@@ -51,16 +188,21 @@ class SpotifyBackup:
         return bdir
 
     def backup_everything(self):
+        """Run all backups concurrently"""
         everything = (
+            # The listening history goes first as it is the most time sensitive
+            # one, see backup_history.
+            self.backup_history,
             self.backup_playlists,
             self.backup_saved_objects,
             self.backup_top_objects,
             self.backup_followed_artists,
-            self.backup_history,
         )
-        for func in everything:
+        with ThreadPoolExecutor(max_workers=len(everything)) as executor:
+            futures = {executor.submit(func): func for func in everything}
+        for future, func in futures.items():
             try:
-                func()
+                future.result()
             except SpotifyException as e:
                 logger.error("Error during backup %s: %s", func.__name__, e)
 
@@ -68,37 +210,103 @@ class SpotifyBackup:
         """Backup a playlist, including all track details"""
         # Check if we have a backup already
         playlist_id = playlist["id"]
-        playlist_path = path / (playlist_id + ".json")
+        playlist_path = self._backup_file(path / playlist_id)
+        # The index is keyed by backup file (like "my/<id>.json.zst"), so a backup
+        # left behind by a run with(out) --compress is not mistaken for this one
+        index_key = playlist_path.relative_to(self._snapshot_ids_path().parent).as_posix()
         # The snapshot_id of spotify playlists changes for every response, so don't
         # bother checking those.
-        if not playlist["owner"]["id"] == "spotify":
-            try:
-                with open(playlist_path, "r") as f:
-                    have_snapshot_id = json.load(f).get("snapshot_id", None)
-            except:  # noqa: E722
-                have_snapshot_id = None
-            if playlist["snapshot_id"] == have_snapshot_id:
+        if not playlist["owner"]["id"] == "spotify" and playlist_path.exists():
+            have = self._snapshot_ids.get(index_key)
+            if have is None:
+                # Not in the index yet (backups created by older versions, which
+                # always backed up all fields)
+                try:
+                    have = {
+                        "snapshot_id": self._read_snapshot_id(playlist_path),
+                        "slim": False,
+                    }
+                except BACKUP_READ_ERRORS as e:
+                    # Unreadable backups are simply replaced
+                    logger.debug("Unable to read %s: %s", playlist_path, e)
+            # A backup made with(out) --slim is replaced when running without (with) it
+            if have == {"snapshot_id": playlist["snapshot_id"], "slim": self.slim}:
                 # We already have a up to date backup of this playlist
                 logger.debug('Playlist "%s": Backup is up to date', playlist["name"])
+                self._snapshot_ids[index_key] = have
                 return
 
-        playlist_result = self.sp.playlist(playlist_id)
-        all_items = playlist_result["tracks"]["items"]
+        fields, page_fields = None, None
+        if self.slim:
+            # Leave out everything but the essentials (like the huge
+            # available_markets lists of every track and album).
+            fields, page_fields = PLAYLIST_FIELDS, PLAYLIST_PAGE_FIELDS
+        playlist_result = self.sp.playlist(playlist_id, fields=fields)
         # Read all tracks and extend the tracks array with all of them.
         # This will keep the order of tracks straight as well.
-        while playlist_result["tracks"]["next"]:
-            track_result = self.sp.next(playlist_result["tracks"])
-            all_items.extend(track_result["items"])
-            track_result["items"] = all_items
-            playlist_result["tracks"] = track_result
+        playlist_result["tracks"]["items"] = self.sp.get_remaining_items(
+            playlist_result["tracks"],
+            self.sp.playlist_items,
+            playlist_id=playlist_id,
+            fields=page_fields,
+            additional_types=("track",),
+        )
 
         self._dump_json(playlist_path, playlist_result)
+        self._snapshot_ids[index_key] = {
+            "snapshot_id": playlist_result["snapshot_id"],
+            "slim": self.slim,
+        }
         logger.info('Playlist "%s": Backup created', playlist["name"])
 
+    def _snapshot_ids_path(self) -> Path:
+        return self.backup_path / "playlists" / SNAPSHOT_IDS_FILE
+
+    def _load_snapshot_ids(self) -> Dict[str, Dict]:
+        """Load the index of playlist backup files (relative to the playlists
+        directory) to their snapshot_id (and whether they have been made with --slim)"""
+        try:
+            with open(self._snapshot_ids_path(), "rb") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_snapshot_ids(self):
+        path = self._ensure_dir(Path("playlists")) / SNAPSHOT_IDS_FILE
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self._snapshot_ids, f, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _open_backup(path: Path) -> BinaryIO:
+        """Open a backup file for reading, decompressing it if needed"""
+        if path.suffix == ".zst":
+            return zstandard.open(path, "rb")
+        return open(path, "rb")
+
+    def _read_snapshot_id(self, path: Path) -> Optional[str]:
+        """Return the snapshot_id of a playlist backup without parsing all of it"""
+        with self._open_backup(path) as f:
+            head = b""
+            # Reads from a zstd stream may return less than requested
+            while len(head) < SNAPSHOT_ID_READ_SIZE:
+                data = f.read(SNAPSHOT_ID_READ_SIZE - len(head))
+                if not data:
+                    break
+                head += data
+        match = SNAPSHOT_ID_RE.search(head)
+        if match:
+            return match.group(1).decode()
+        # Fall back to parsing the whole file
+        with self._open_backup(path) as f:
+            return json.load(f).get("snapshot_id", None)
+
     def backup_playlists(self):
         """Backup all users playlists (own and starred)"""
         logger.info("Backing up playlists")
         path = Path("playlists")
+        work = []
         for playlist in self.sp.get_all_items(self.sp.current_user_playlists):
             if playlist is None:
                 # The API started returning None/null items alongside SimplifiedPlaylistObjects
@@ -111,51 +319,71 @@ class SpotifyBackup:
             else:
                 # starred playlist
                 backup_dir = self._ensure_dir(path / "starred")
-            self._backup_playlist(playlist, backup_dir)
+            work.append((playlist, backup_dir))
+
+        self._run_concurrently(self._backup_playlist, work)
+        self._save_snapshot_ids()
+
+    def _run_concurrently(self, func: Callable, work: Iterable[Tuple]):
+        """Call func for every argument tuple in work using a thread pool
+
+        Errors are logged per work item so that one failing item does not abort
+        the others.
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(func, *args): args for args in work}
+        for future, args in futures.items():
+            try:
+                future.result()
+            except SpotifyException as e:
+                logger.error("Error during %s%s: %s", func.__name__, args, e)
 
     def backup_saved_objects(self, objtype: Optional[_SAVED_OBJECT_TYPES] = None):
         """Backup users saved objects"""
 
         def _dump(objtype):
             logger.info("Backing up saved %s", objtype)
-            func = getattr(self.sp, "current_user_saved_" + objtype)
-            result = self.sp.get_all_items(func)
-            self._dump_json(self._ensure_dir() / f"saved_{objtype}.json", result)
+            self._dump_json_array(
+                self._ensure_dir() / f"saved_{objtype}.json",
+                self.sp.iter_all_items(self._saved_fetchers[objtype]),
+            )
 
         if objtype is None:
-            for objtype in SAVED_OBJECT_TYPES:
-                _dump(objtype)
+            self._run_concurrently(_dump, ((o,) for o in SAVED_OBJECT_TYPES))
         else:
             _dump(objtype)
 
     def backup_top_objects(self, objtype: Optional[_TOP_OBJECT_TYPES] = None):
         """Backup users top objects"""
 
-        def _dump(objtype):
-            for top_range in TOP_RANGES:
-                logger.info("Backing up top %s %s", objtype, top_range)
-                func = getattr(self.sp, "current_user_top_" + objtype)
-                result = self.sp.get_all_items(func, time_range=top_range)
-                self._dump_json(
-                    self._ensure_dir() / f"top_{objtype}_{top_range}.json", result
-                )
-
-        if objtype is None:
-            for objtype in TOP_OBJECT_TYPES:
-                _dump(objtype)
-        else:
-            _dump(objtype)
+        def _dump(objtype, top_range):
+            logger.info("Backing up top %s %s", objtype, top_range)
+            self._dump_json_array(
+                self._ensure_dir() / f"top_{objtype}_{top_range}.json",
+                self.sp.iter_all_items(
+                    self._top_fetchers[objtype], time_range=top_range
+                ),
+            )
+
+        objtypes = TOP_OBJECT_TYPES if objtype is None else (objtype,)
+        self._run_concurrently(
+            _dump, ((o, r) for o in objtypes for r in TOP_RANGES)
+        )
 
     def backup_followed_artists(self):
         """Backup users followed artists"""
 
+        def _iter_artists():
+            result = self.sp.current_user_followed_artists()["artists"]
+            yield from result["items"]
+            while result["next"]:
+                result = self.sp.next(result)["artists"]
+                yield from result["items"]
+
         logger.info("Backing up followed artists")
-        result = self.sp.current_user_followed_artists()["artists"]
-        artists = result["items"]
-        while result["next"]:
-            result = self.sp.next(result)["artists"]
-            artists.extend(result["items"])
-        self._dump_json(self._ensure_dir() / "followed_artists.json", artists)
+        self._dump_json_array(
+            self._ensure_dir() / "followed_artists.json", _iter_artists()
+        )
 
     def backup_history(self):
         """Backup listening history
@@ -200,28 +428,43 @@ def main():
     parser.add_argument(
         "--pretty", action="store_true", help='Create "pretty" JSON files'
     )
+    parser.add_argument(
+        "--slim",
+        action="store_true",
+        help="Only backup the essential fields of playlists and their tracks",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=MAX_WORKERS,
+        help="Number of playlists (and saved/top objects) to backup concurrently",
+    )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="Compress backup files with zstd (.json.zst, requires zstandard)",
+    )
     parser.add_argument(
         "--history-only", action="store_true", help="Backup listening history only"
     )
 
     args = parser.parse_args()
 
-    level = logging.WARNING
-    if args.verbose is not None:
-        if args.verbose > 0:
-            level = logging.INFO
-        if args.verbose > 1:
-            level = logging.DEBUG
-    logging.basicConfig(
-        format="%(asctime)s [%(levelname)s] (%(name)s.%(funcName)s) %(message)s",
-        level=level,
-    )
+    if args.compress and zstandard is None:
+        parser.error("--compress requires the zstandard package")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
 
-    sb = SpotifyBackup(args.backup_dir, args.pretty)
-    if args.history_only:
-        sb.backup_history()
-    else:
-        sb.backup_everything()
+    setup_logging(args.verbose)
+
+    sb = SpotifyBackup(
+        args.backup_dir, args.pretty, args.slim, args.compress, args.workers
+    )
+    with sb.sp:
+        if args.history_only:
+            sb.backup_history()
+        else:
+            sb.backup_everything()
 
 
 if __name__ == "__main__":
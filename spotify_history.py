@@ -5,15 +5,29 @@ import json
 import logging
 import sqlite3
 import sys
-from collections.abc import MutableMapping
-from contextlib import suppress
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 from datetime import UTC, date, datetime, timedelta
 from pathlib import Path
-from typing import List
+from typing import Iterable, Iterator, List
 
 from tabulate import tabulate
 
-from spotify import SpotifyClient
+from spotify import SpotifyClient, setup_logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
+try:
+    import ijson
+except ImportError:
+    ijson = None  # type: ignore
 
 MIGRATIONS = {
     1: (
@@ -37,37 +51,129 @@ CREATE TABLE IF NOT EXISTS "tracks" (
         "ALTER TABLE history ADD COLUMN ms_played INTEGER;",
         ["backfill_ms_played"],
     ),
+    3: (
+        # Index for joining history with tracks and counting plays per track
+        "CREATE INDEX IF NOT EXISTS history_track_id ON history (track_id);",
+        [],
+    ),
+    4: (
+        """
+ALTER TABLE tracks ADD COLUMN name TEXT
+    GENERATED ALWAYS AS (json_extract(data, '$.name')) VIRTUAL;
+ALTER TABLE tracks ADD COLUMN artist_name TEXT
+    GENERATED ALWAYS AS (json_extract(data, '$.artists[0].name')) VIRTUAL;
+ALTER TABLE tracks ADD COLUMN duration_ms INTEGER
+    GENERATED ALWAYS AS (json_extract(data, '$.duration_ms')) VIRTUAL;
+""",
+        [],
+    ),
+    5: (
+        "",
+        ["convert_track_data_to_jsonb"],
+    ),
+    6: (
+        # Rebuild tracks to store the generated columns, so queries don't extract them
+        # from the JSON data for every row. Generated columns can't be changed nor added
+        # as STORED via ALTER TABLE.
+        """
+PRAGMA foreign_keys = OFF;
+BEGIN;
+CREATE TABLE "tracks_new" (
+    track_id TEXT PRIMARY KEY,
+    data JSON,
+    name TEXT GENERATED ALWAYS AS (json_extract(data, '$.name')) STORED,
+    artist_name TEXT GENERATED ALWAYS AS (json_extract(data, '$.artists[0].name')) STORED,
+    duration_ms INTEGER GENERATED ALWAYS AS (json_extract(data, '$.duration_ms')) STORED
+);
+INSERT INTO tracks_new (track_id, data) SELECT track_id, data FROM tracks;
+DROP TABLE tracks;
+ALTER TABLE tracks_new RENAME TO tracks;
+COMMIT;
+PRAGMA foreign_keys = ON;
+""",
+        [],
+    ),
 }
 
+# SQLite >= 3.45 can store JSON in its binary format (JSONB), which saves parsing
+# the JSON text for every json_extract. All JSON functions accept both formats.
+JSONB_SUPPORTED = sqlite3.sqlite_version_info >= (3, 45, 0)
+TRACK_DATA_VALUE = "jsonb(?)" if JSONB_SUPPORTED else "?"
+
+UPSERT_TRACK_SQL = f"""
+INSERT INTO tracks (track_id, data) VALUES (?, {TRACK_DATA_VALUE})
+    ON CONFLICT (track_id) DO UPDATE SET data = excluded.data
+        WHERE tracks.data IS NULL
+"""
+INSERT_HISTORY_SQL = "INSERT OR IGNORE INTO history VALUES (unixepoch(?), ?, ?)"
+UPSERT_HISTORY_SQL = """
+INSERT INTO history (played_at, track_id, ms_played) VALUES (unixepoch(?), ?, ?)
+    ON CONFLICT (played_at) DO UPDATE SET ms_played = excluded.ms_played
+        WHERE history.ms_played IS NULL
+"""
+# Maximum number of bytes of the database file accessed via memory mapping
+MMAP_SIZE = 256 * 1024 * 1024
+# Number of rows examined per index when gathering statistics for the query planner
+ANALYSIS_LIMIT = 1000
+# Number of pages in the WAL after which it is checkpointed into the database
+WAL_AUTOCHECKPOINT = 1000
+# Keys removed from history items and tracks before storing them
+CLEANUP_KEYS = frozenset(
+    (
+        "available_markets",
+        "context",
+        "images",
+        "preview_url",
+        "external_urls",
+        "href",
+    )
+)
+# Number of batches of track data fetched concurrently by backfill_track_data
+BACKFILL_WORKERS = 6
+# Number of batches of track data backfilled per transaction
+BACKFILL_COMMIT_BATCHES = 10
 
 logger = logging.getLogger(__name__)
 
 
-def dict_factory(cursor: sqlite3.Cursor, row: tuple) -> dict:
-    fields = [column[0] for column in cursor.description]
-    return {key: value for key, value in zip(fields, row)}
+def json_dumps(obj) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
+
+
+def json_loads(data: bytes):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def convert_unixepoch(ts: bytes) -> datetime:
+    return datetime.fromtimestamp(int(ts), UTC)
+
 
+# Convert datetime objects to unix timestamps when inserting into the database
+# sqlite3.register_adapter(datetime, lambda dt: timegm(dt.utctimetuple()))
+# Convert cells with type "unixepoch" to datetime objects
+sqlite3.register_converter("unixepoch", convert_unixepoch)
 
-def print_table(history: List[dict], headers: tuple | dict = None):
+
+def print_table(history: List[sqlite3.Row], headers: tuple | dict = None):
     def _sorted():
         keys = list(headers.keys())
         for item in history:
             # Yield a dict that only contains keys referenced in the headers
             # ordered by the order of the headers.
-            yield dict(
-                sorted(
-                    filter(lambda pair: pair[0] in keys, item.items()),
-                    key=lambda pair: keys.index(pair[0]),
-                )
-            )
+            item_keys = item.keys()
+            yield {key: item[key] for key in keys if key in item_keys}
 
     if isinstance(headers, tuple):
         # tabulate requires headers to be a dict if table data is a list of dicts
         headers = {h: h for h in headers}
 
     if headers is None:
-        # If headers are None, instruct tabulate to use the the dictionary keys directly
-        headers = "keys"
+        # If headers are None, use the column names of the rows directly
+        headers = history[0].keys() if history else ()
         # No sorting required/possible, so just pass the history as-is
         data = history
     else:
@@ -81,24 +187,23 @@ def print_table(history: List[dict], headers: tuple | dict = None):
         sys.stderr.close()
 
 
-def delete_keys_from_dict(dictionary, keys):
+def delete_keys_from_dict(dictionary: dict, keys):
     for key in keys:
-        with suppress(KeyError):
-            del dictionary[key]
+        dictionary.pop(key, None)
+    # Decoded JSON only contains plain dicts and lists, so compare the types
+    # directly instead of using isinstance.
     for value in dictionary.values():
-        if isinstance(value, MutableMapping):
+        if type(value) is dict:
             delete_keys_from_dict(value, keys)
+        elif type(value) is list:
+            # Like the artists of a track
+            for item in value:
+                if type(item) is dict:
+                    delete_keys_from_dict(item, keys)
 
 
 class SpotifyHistoryDB:
     def __init__(self, db_file: Path, sql_debug=False):
-        # Convert datetime objects to unix timestamps when inserting into the database
-        # sqlite3.register_adapter(datetime, lambda dt: timegm(dt.utctimetuple()))
-        # Convert cells with type "unixepoch" to datetime objects
-        sqlite3.register_converter(
-            "unixepoch", lambda ts: datetime.fromtimestamp(int(ts), UTC)
-        )
-
         if isinstance(db_file, str):
             db_file = Path(db_file)
         self.db_file = db_file
@@ -114,15 +219,42 @@ class SpotifyHistoryDB:
     def create_connection(self) -> sqlite3.Connection:
         con = sqlite3.connect(str(self.db_file), detect_types=sqlite3.PARSE_COLNAMES)
         con.execute("PRAGMA foreign_keys = ON")
+        con.execute("PRAGMA temp_store = MEMORY")
+        # 64 MiB page cache (negative values are KiB)
+        con.execute("PRAGMA cache_size = -65536")
+        # Only examine this many rows per index to gather statistics (ANALYZE/optimize)
+        con.execute(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+        if str(self.db_file) != ":memory:":
+            # With a write-ahead log, commits don't need to fsync the database file
+            # (only the WAL on checkpoints) which makes writes a lot cheaper.
+            con.execute("PRAGMA journal_mode = WAL")
+            con.execute("PRAGMA synchronous = NORMAL")
+            con.execute(f"PRAGMA wal_autocheckpoint = {WAL_AUTOCHECKPOINT}")
+            con.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
         return con
 
+    def _get_reader(self) -> sqlite3.Connection:
+        """Open an additional read-only connection to the database
+
+        With the write-ahead log, it can read while self.con is writing.
+        """
+        uri = f"{self.db_file.absolute().as_uri()}?mode=ro"
+        return sqlite3.connect(uri, uri=True)
+
     def close_connection(self):
+        self.optimize()
         self.con.close()
 
+    def optimize(self):
+        """Update the statistics of the query planner, if SQLite thinks it's worth it"""
+        self.con.execute("PRAGMA optimize")
+
     def _apply_migrations(self):
+        applied = False
         for version, migration in MIGRATIONS.items():
             query, funcs = migration
             if version > self.db_version:
+                applied = True
                 logger.info(f"Applying migration {version}")
                 with self.con:
                     self.con.executescript(query)
@@ -133,61 +265,34 @@ class SpotifyHistoryDB:
                         ret = getattr(self, func)()
                         logger.info(f"Function {func} returned: {ret}")
                     logger.info(f"Applied migration {version}")
+        if applied:
+            # Gather statistics about the (new) tables and indexes for the query planner
+            self.con.execute("ANALYZE")
 
     def _cleanup_history_items(self, items):
         """Remove (probably irrelevant) keys from the history items to reduce the size of the history database"""
         for item in items:
-            delete_keys_from_dict(
-                item,
-                (
-                    "available_markets",
-                    "context",
-                    "images",
-                    "preview_url",
-                    "external_urls",
-                    "href",
-                ),
-            )
-
-    def _insert_history_item(
-        self, cur: sqlite3.Cursor, played_at: int, track_id: str, ms_played: int = None
-    ) -> int:
-        return cur.execute(
-            "INSERT OR IGNORE INTO history VALUES (unixepoch(?), ?, ?)",
-            (
-                played_at,
-                track_id,
-                ms_played,
-            ),
-        ).rowcount
-
-    def _insert_track(self, cur: sqlite3.Cursor, track_id: str, track: dict = None):
-        if track is None:
-            # This uses the "INSERT OR IGNORE" clause to avoid overriding existing tracks data with NULL
-            cur.execute(
-                "INSERT OR IGNORE INTO tracks (track_id) VALUES (?)", (track_id,)
-            )
-        else:
-            cur.execute(
-                "INSERT OR REPLACE INTO tracks VALUES (?, ?)",
-                (track_id, json.dumps(track)),
-            )
+            delete_keys_from_dict(item, CLEANUP_KEYS)
 
     def insert_play_history_objects(self, play_history_objects: List, backfill_from: int = None) -> int:
         self._cleanup_history_items(play_history_objects)
-        cur = self.con.cursor()
-        history_items_added = 0
-        for item in play_history_objects:
-            track = item["track"]
-            track_id = track["id"]
-            try:
-                history_items_added += self._insert_history_item(cur, item["played_at"], track_id)
-            except sqlite3.IntegrityError:
-                self._insert_track(cur, track_id, track)
-                history_items_added += self._insert_history_item(cur, item["played_at"], track_id)
+        # Tracks played repeatedly only need to be encoded and upserted once
+        tracks = {item["track"]["id"]: item["track"] for item in play_history_objects}
+        with self.con:
+            # Take the write lock upfront instead of when the first insert happens
+            self.con.execute("BEGIN IMMEDIATE")
+            # Tracks have to be inserted first to satisfy the foreign key of the history.
+            # The data of tracks which are already known is kept, unless it is missing
+            # (like for tracks imported from GDPR data).
+            self.con.executemany(
+                UPSERT_TRACK_SQL,
+                [(track_id, json_dumps(track)) for track_id, track in tracks.items()],
+            )
+            history_items_added = self.con.executemany(
+                INSERT_HISTORY_SQL,
+                [(item["played_at"], item["track"]["id"], None) for item in play_history_objects],
+            ).rowcount
 
-        cur.close()
-        self.con.commit()
         if backfill_from:
             # Calculate ms_played for what was previously the last history item
             # as well as all new history items added above
@@ -197,129 +302,156 @@ class SpotifyHistoryDB:
     def insert_from_gdpr_json(self, json_file: Path, backfill=False):
         """Parse the listening history from a GDPR request data JSON file
         into a format compatible with what we get from spotify recently played API"""
-        history = set()
-        with json_file.open("r") as f:
-            data = json.load(f)
+        history = []
+        with json_file.open("rb") as f:
+            if ijson is not None:
+                # Parse the entries one by one instead of loading the whole file
+                data = ijson.items(f, "item")
+            else:
+                data = json_loads(f.read())
             for entry in data:
-                if any(
-                    map(
-                        lambda x: entry.get(x) is None,
-                        ["ts", "ms_played", "spotify_track_uri"],
-                    )
-                ):
+                played_at = entry.get("ts")
+                ms_played = entry.get("ms_played")
+                track_uri = entry.get("spotify_track_uri")
+                if played_at is None or ms_played is None or track_uri is None:
                     # Skip entries missing relevant data (like podcast episodes)
                     continue
-                ms_played = entry["ms_played"]
                 if ms_played == 0:
                     # Skip tracks which have not been played
                     continue
-                played_at = entry["ts"]
-                track_id = entry["spotify_track_uri"].split(":")[-1]
-                history.add((played_at, track_id, ms_played))
-
-        cur = self.con.cursor()
-        tracks_added = cur.executemany(
-            "INSERT OR IGNORE INTO tracks (track_id) VALUES (?)",
-            [(track_id,) for _, track_id, _ in history],
-        ).rowcount
-        logger.info(f"Added {tracks_added} tracks")
-        history_added = cur.executemany(
-            "INSERT OR IGNORE INTO history VALUES (unixepoch(?), ?, ?)", history
-        ).rowcount
-        logger.info(f"Added {history_added} history items")
-        history_updated = cur.executemany(
-            "UPDATE history SET ms_played=? WHERE played_at=unixepoch(?) and ms_played IS NULL",
-            [[h[2], h[0]] for h in history],
-        ).rowcount
-        logger.info(f"Updated {history_updated} history items with ms_played")
-        cur.close()
-        self.con.commit()
+                track_id = track_uri.rpartition(":")[2]
+                history.append((played_at, track_id, ms_played))
+        # Duplicate entries are dropped by the database (played_at being the primary key)
+        track_ids = dict.fromkeys(track_id for _, track_id, _ in history)
+
+        with self.con:
+            self.con.execute("BEGIN IMMEDIATE")
+            tracks_added = self.con.executemany(
+                "INSERT OR IGNORE INTO tracks (track_id) VALUES (?)",
+                ((track_id,) for track_id in track_ids),
+            ).rowcount
+            logger.info(f"Added {tracks_added} tracks")
+            # Add new history items and fill in ms_played of known ones in a single pass
+            history_upserted = self.con.executemany(UPSERT_HISTORY_SQL, history).rowcount
+            logger.info(f"Added or updated {history_upserted} history items")
+        self.optimize()
 
         if backfill:
             self.backfill_track_data()
 
     def backfill_track_data(self):
         """Fetches missing track data for all tracks in the database"""
-        cur = self.con.cursor()
-        cur.execute("SELECT track_id FROM tracks WHERE data IS NULL")
-        track_ids = [row[0] for row in cur.fetchall()]
-        tracks_to_backfill = len(track_ids)
+        cur = self.con.execute("SELECT COUNT(*) FROM tracks WHERE data IS NULL")
+        tracks_to_backfill = cur.fetchone()[0]
         if tracks_to_backfill == 0:
             return
 
-        spotify = SpotifyClient()
-
-        def _batch(iterable, n=1):
-            iter_length = len(iterable)
-            for ndx in range(0, iter_length, n):
-                yield iterable[ndx : min(ndx + n, iter_length)]  # noqa: E203
+        # Stream the IDs from a separate connection while self.con writes the
+        # track data. An in-memory database can't be shared, so read all upfront.
+        query = "SELECT track_id FROM tracks WHERE data IS NULL"
+        reader = None
+        if str(self.db_file) == ":memory:":
+            track_ids = [row[0] for row in self.con.execute(query)]
+        else:
+            reader = self._get_reader()
+            track_ids = (row[0] for row in reader.execute(query))
 
-        # Fetch track data in batches of 50
-        # API docs say maximum of 100, but that cake is a lie
         cur = self.con.cursor()
         backfilled_tracks = 0
-        for batch in _batch(track_ids, 50):
-            tracks = spotify.tracks(tracks=batch)["tracks"]
-            self._cleanup_history_items(tracks)
-            backfilled_tracks += cur.executemany(
-                "UPDATE tracks SET data=? WHERE track_id=?",
-                [(json.dumps(track), track["id"]) for track in tracks],
-            ).rowcount
-            # Ensure data is committed to the database after each batch
-            self.con.commit()
-            logger.info(
-                f"Backfilled {backfilled_tracks} of {tracks_to_backfill} tracks"
-            )
+        try:
+            with SpotifyClient() as spotify:
+                for batches_done, tracks in enumerate(
+                    self._fetch_tracks(spotify, track_ids), start=1
+                ):
+                    self._cleanup_history_items(tracks)
+                    backfilled_tracks += cur.executemany(
+                        f"UPDATE tracks SET data={TRACK_DATA_VALUE} WHERE track_id=?",
+                        [(json_dumps(track), track["id"]) for track in tracks],
+                    ).rowcount
+                    # Commit every few batches, so not too much work is lost on errors
+                    if batches_done % BACKFILL_COMMIT_BATCHES == 0:
+                        self.con.commit()
+                    logger.info(
+                        f"Backfilled {backfilled_tracks} of {tracks_to_backfill} tracks"
+                    )
+        finally:
+            if reader is not None:
+                reader.close()
         cur.close()
+        self.con.commit()
+        self.optimize()
+
+    @staticmethod
+    def _fetch_tracks(
+        spotify: SpotifyClient, track_ids: Iterable[str]
+    ) -> Iterator[List]:
+        """Yield the track data for track_ids in batches, as soon as each arrives
+
+        The batches are fetched concurrently, with a bounded number of requests in
+        flight so that track_ids is only consumed as fast as the requests complete.
+        """
+        with ThreadPoolExecutor(max_workers=BACKFILL_WORKERS) as executor:
+            pending = set()
+            # Fetch track data in batches of 50
+            # API docs say maximum of 100, but that cake is a lie
+            for batch in spotify.chunks(track_ids, 50):
+                pending.add(executor.submit(spotify.tracks, tracks=batch))
+                if len(pending) >= 2 * BACKFILL_WORKERS:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()["tracks"]
+            for future in as_completed(pending):
+                yield future.result()["tracks"]
 
     def backfill_ms_played(self, backfill_from: int = 0) -> int:
-        cur = self.con.cursor()
-        cur.row_factory = dict_factory
-        cur.execute(
-            """
-            SELECT
-                h.played_at,
-                t.track_id,
-                json_extract(t.data, '$.duration_ms') AS duration_ms,
-                ms_played
-                FROM history h
-                JOIN tracks t ON h.track_id = t.track_id
-                WHERE played_at >= ?
-                ORDER BY h.played_at
+        # Calculate a plausible ms_played for each track as spotify does only provide that field in the GDPR data export.
+        # If the next track was played before the full playback of the current track, calculate the ms_played from
+        # the time between the start of the current track and the start of the next track (in milliseconds).
+        # Otherwise, assume the track was played in full.
+        # The last track is skipped as there is no next track yet.
+        if self.db_version >= 6:
+            # Stored since migration 6, so this doesn't need SQLite to read the track
+            # data (which SQLite < 3.45 can't once it has been converted to JSONB).
+            duration_ms = "t.duration_ms"
+        else:
+            # Running as part of migration 2
+            duration_ms = "json_extract(t.data, '$.duration_ms')"
+        cur = self.con.execute(
+            f"""
+            UPDATE history
+                SET ms_played = MIN(n.duration_ms, (n.next_played_at - n.played_at) * 1000)
+                FROM (
+                    SELECT
+                        h.played_at,
+                        {duration_ms} AS duration_ms,
+                        LEAD(h.played_at) OVER (ORDER BY h.played_at) AS next_played_at
+                        FROM history h
+                        JOIN tracks t ON h.track_id = t.track_id
+                        WHERE h.played_at >= ?
+                ) AS n
+                WHERE
+                    history.played_at = n.played_at
+                    AND history.ms_played IS NULL
+                    AND n.next_played_at IS NOT NULL
+                    AND n.duration_ms IS NOT NULL
             """,
             (backfill_from,),
         )
-        data = cur.fetchall()
-        # Calculate a plausible ms_played for each track as spotify does only provide that field in the GDPR data export
-        for idx, row in enumerate(data):
-            if row["ms_played"] is not None:
-                # Skip rows that already have a ms_played value
-                continue
-            try:
-                next_row = data[idx + 1]
-            except IndexError:
-                # last track, nothing to do
-                break
-            # Calculate the end time of a full playback of the current track
-            full_play = row["played_at"] + (row["duration_ms"] / 1000)
-
-            # If the next track was played before the full playback of the current track, calculate the ms_played from
-            # the time between the start of the current track and the start of the next track (in milliseconds).
-            # Otherwise, assume the track was played in full.
-            if next_row["played_at"] < full_play:
-                row["ms_played"] = (next_row["played_at"] - row["played_at"]) * 1000
-            else:
-                row["ms_played"] = row["duration_ms"]
-
-        history_updated = cur.executemany(
-            "UPDATE history SET ms_played=? WHERE played_at=? AND ms_played IS NULL",
-            [(x["ms_played"], x["played_at"]) for x in data],
-        ).rowcount
+        history_updated = cur.rowcount
         logger.info(f"Backfilled {history_updated} ms_played values")
         cur.close()
         self.con.commit()
         return history_updated
 
+    def convert_track_data_to_jsonb(self) -> int:
+        """Convert the track data stored as JSON text to JSONB (if supported)"""
+        if not JSONB_SUPPORTED:
+            return 0
+        cur = self.con.execute(
+            "UPDATE tracks SET data = jsonb(data) WHERE data IS NOT NULL"
+        )
+        return cur.rowcount
+
     def get_most_recent_timestamp(self) -> int:
         cur = self.con.execute("SELECT MAX(played_at) FROM history")
         timestamp = cur.fetchone()[0]
@@ -327,31 +459,48 @@ class SpotifyHistoryDB:
             return 0
         return timestamp
 
-    def get_history(self, start, end: datetime = None, limit: int = -1) -> List[dict]:
+    def get_history(
+        self, start, end: datetime = None, limit: int = -1
+    ) -> List[sqlite3.Row]:
+        return self._get_history(
+            'h.played_at as "played_at [unixepoch]"', start, end, limit
+        )
+
+    def get_history_raw(
+        self, start, end: datetime = None, limit: int = -1
+    ) -> List[sqlite3.Row]:
+        """Like get_history, but with played_at formatted as string (UTC) by SQLite
+        instead of being converted to datetime objects, which is cheaper for listings"""
+        return self._get_history(
+            "datetime(h.played_at, 'unixepoch') as played_at", start, end, limit
+        )
+
+    def _get_history(
+        self, played_at_column: str, start, end, limit
+    ) -> List[sqlite3.Row]:
         cur = self.con.cursor()
-        cur.row_factory = dict_factory
+        cur.row_factory = sqlite3.Row
 
         args = (limit,)
         where_clause = ""
+        # Compare played_at directly (rather than converting it), so that SQLite
+        # can look up the range via the primary key.
         if start and end:
-            where_clause = """
-                WHERE
-                    datetime(h.played_at, 'unixepoch') BETWEEN datetime(?) AND datetime(?)
-                """
+            where_clause = "WHERE h.played_at BETWEEN unixepoch(?) AND unixepoch(?)"
             args = (start, end, limit)
         elif start:
-            where_clause = "WHERE datetime(h.played_at, 'unixepoch') >= datetime(?)"
+            where_clause = "WHERE h.played_at >= unixepoch(?)"
             args = (start, limit)
         elif end:
-            where_clause = " AND datetime(h.played_at, 'unixepoch') <= datetime(?)"
+            where_clause = "WHERE h.played_at <= unixepoch(?)"
             args = (end, limit)
 
         cur.execute(
             f"""
             SELECT
-                h.played_at as "played_at [unixepoch]",
-                json_extract(t.data, '$.name') AS track_name,
-                json_extract(t.data, '$.artists[0].name') AS artist_name,
+                {played_at_column},
+                t.name AS track_name,
+                t.artist_name,
                 h.track_id
             FROM
                 history h
@@ -366,48 +515,62 @@ class SpotifyHistoryDB:
         )
         return cur.fetchall()
 
-    def get_top_tracks(self, start, end: date, limit: int = -1) -> List[dict]:
+    def get_top_tracks(
+        self, start, end: date, limit: int = -1
+    ) -> List[sqlite3.Row]:
         logger.debug(f"Getting top tracks from {start} to {end}")
         cur = self.con.cursor()
-        cur.row_factory = dict_factory
+        cur.row_factory = sqlite3.Row
         cur.execute(
             """
+            -- Count the plays using the history only and look up the track data
+            -- of the top tracks afterwards.
+            WITH play_counts AS (
+                SELECT
+                    track_id,
+                    MIN(played_at) AS played_first_at,
+                    COUNT(*) AS play_count
+                FROM
+                    history
+                WHERE
+                    played_at >= unixepoch(?) AND played_at < unixepoch(?, '+1 day')
+                GROUP BY
+                    track_id
+                ORDER BY
+                    play_count DESC, played_first_at ASC
+                LIMIT ?
+            )
             SELECT
                 t.track_id,
-                json_extract(t.data, '$.name') AS track_name,
-                json_extract(t.data, '$.artists[0].name') AS artist_name,
-                MIN(h.played_at) as "played_first_at [unixepoch]",
-                COUNT(h.track_id) AS play_count
+                t.name AS track_name,
+                t.artist_name,
+                c.played_first_at as "played_first_at [unixepoch]",
+                c.play_count
             FROM
-                history h
+                play_counts c
             JOIN
-                tracks t ON h.track_id = t.track_id
-            WHERE
-                date(h.played_at, 'unixepoch') BETWEEN date(?) AND date(?)
-            GROUP BY
-                t.track_id
+                tracks t ON c.track_id = t.track_id
             ORDER BY
-                play_count DESC, played_at ASC
-            LIMIT ?
+                c.play_count DESC, c.played_first_at ASC
             """,
             (start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d"), limit),
         )
         return cur.fetchall()
 
-    def get_today_last_year(self, limit: int = -1) -> List[dict]:
+    def get_today_last_year(self, limit: int = -1) -> List[sqlite3.Row]:
         today_last_year = date.today().replace(year=date.today().year - 1)
         return self.get_top_tracks(today_last_year, today_last_year, limit)
 
 
 def cmd_history(db: SpotifyHistoryDB, args: argparse.Namespace):
-    history = db.get_history(args.start, args.end)
-    start = history[-1]["played_at"].strftime("%Y-%m-%d %H:%M:%s")
-    end = history[0]["played_at"].strftime("%Y-%m-%d %H:%M:%s")
+    history = db.get_history_raw(args.start, args.end)
+    start = history[0]["played_at"]
+    end = history[-1]["played_at"]
     print(f"Listening History from {start} to {end}, {len(history)} items:")
     if args.create_playlist:
-        spotify = SpotifyClient()
         track_ids = [item["track_id"] for item in history]
-        playlist = spotify.create_playlist(args.create_playlist, track_ids)
+        with SpotifyClient() as spotify:
+            playlist = spotify.create_playlist(args.create_playlist, track_ids)
         print(
             f"Playlist created with {len(track_ids)} tracks: {playlist['external_urls']['spotify']}"
         )
@@ -535,16 +698,7 @@ def main():
 
     args = parser.parse_args()
 
-    level = logging.WARNING
-    if args.verbose is not None:
-        if args.verbose > 0:
-            level = logging.INFO
-        if args.verbose > 1:
-            level = logging.DEBUG
-    logging.basicConfig(
-        format="%(asctime)s [%(levelname)s] (%(name)s.%(funcName)s) %(message)s",
-        level=level,
-    )
+    setup_logging(args.verbose)
 
     try:
         func = args.func